@@ -1,14 +1,19 @@
+import asyncio
 import base64
+import binascii
 import hashlib
-import itertools
+import re
+import time
+from collections import OrderedDict
 from contextlib import asynccontextmanager
-from hashlib import sha1
-from typing import AnyStr, Optional, Union
-from urllib.parse import urlparse
+from functools import lru_cache
+from typing import AnyStr, Iterable, Optional, Union
 
-import attrs
+from sqlalchemy import bindparam, event, exists, or_
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.asyncio import (AsyncEngine, async_sessionmaker,
                                     create_async_engine)
+from sqlalchemy.orm import selectinload
 from sqlmodel import Field, Relationship, SQLModel, select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
@@ -17,15 +22,42 @@ __author__ = "Calloc"
 __version__ = "0.0.1"
 
 
+@lru_cache(maxsize=32)
+def _tile_key(key:bytes, size:int):
+    """Repeats the key out to size bytes and returns it as one big integer"""
+    return int.from_bytes((key * (size // len(key) + 1))[:size], "little")
+
+def _xor_tiled(data:bytes, tiled_key:int):
+    # XOR the whole payload as one integer so the work stays in C instead of a byte loop
+    size = len(data)
+    return (int.from_bytes(data, "little") ^ tiled_key).to_bytes(size, "little")
+
 def cyclic_xor(data:bytes, key:bytes):
-    return bytes(d ^ k for d, k in zip(data, itertools.cycle(key)))
+    if not key:
+        return b""
+    return _xor_tiled(data, _tile_key(key, len(data)))
+
+COMMENT_KEY = b"29481"
+COMMENT_SALT = b"xPT6iUrtws0J"
+
+# sha1 hexdigests are always 40 bytes which is also lcm(8, len(COMMENT_KEY)) so tile 
+# the comment key once at import and hand it straight to every comment chk.
+_COMMENT_KEY_TILE = _tile_key(COMMENT_KEY, 40)
+
 
 def xor_encode(data:bytes, key:bytes):
     return base64.urlsafe_b64encode(cyclic_xor(data, key))
 
 
+def _chk_digest(value:bytes, salt:bytes):
+    # feed the salt in separately so we don't copy value just to glue the salt on
+    h = hashlib.new("sha1", value, usedforsecurity=False)
+    h.update(salt)
+    # hexlify hands back the hex as bytes directly, no str to encode again
+    return binascii.hexlify(h.digest())
+
 def generate_chk(value:bytes, key:bytes, salt:bytes):
-    return xor_encode(hashlib.sha1(value + salt).hexdigest().encode(), key)
+    return xor_encode(_chk_digest(value, salt), key)
 
 # NOTE: Defaults are set for uploadAccComment which is the profile comment, 
 # to change the id param should not be "0" and comment type should be set to "1"
@@ -36,7 +68,28 @@ def comment_chk(
     percentage: Union[str, int] = 0,
     comment_type: Union[str, int] = 0,
 ):
-    return generate_chk(f"{username}{content}{id}{percentage}{comment_type}".encode("utf-8"), b"29481", b"xPT6iUrtws0J")
+    return _comment_chk_cached(username, content, id, percentage, comment_type)
+
+# Retry loops after a ban tend to resend the exact same comment so remember the last few chks
+# typed so 1, 1.0 and True don't share a chk, they format into different messages
+@lru_cache(maxsize=1024, typed=True)
+def _comment_chk_cached(
+    username: str,
+    content: str,
+    id: Union[str, int],
+    percentage: Union[str, int],
+    comment_type: Union[str, int],
+):
+    digest = _chk_digest(f"{username}{content}{id}{percentage}{comment_type}".encode("utf-8"), COMMENT_SALT)
+    return base64.urlsafe_b64encode(_xor_tiled(digest, _COMMENT_KEY_TILE))
+
+def comment_chk_batch(comments:Iterable[tuple]):
+    """Makes chks for many comments at once, each item carries the same 
+    arguments comment_chk takes in the same order"""
+    # hashlib only lets go of the GIL for inputs over 2047 bytes and comments never get that big,
+    # threads would only add overhead here so a plain loop over the cached chk is the fastest we get
+    return [comment_chk(*args) for args in comments]
+
 
 
 def encode(data:AnyStr):
@@ -50,16 +103,39 @@ def fix_skid_proxy(ip:str):
 
 
 
+# scheme://[user:pass@]host[:port] is all we ever expect to see from a proxy
+_PROXY_HOST_RE = re.compile(r"[A-Za-z][A-Za-z0-9+.-]*://(?:[^/?#]*@)?(\[[^\]/?#]*\]|[^:/?#]*)")
+
+def proxy_host(proxy:str):
+    """Pulls the host out of a proxy url or bare IP address, 
+    lowercased and without brackets, None if there isn't one"""
+    match = _PROXY_HOST_RE.match(fix_skid_proxy(proxy))
+    if match is None:
+        return None
+    return match.group(1).strip("[]").lower() or None
+
+
+
+# The user who caused the ban sits in the last set of parentheses at the end of the reason
+_BAN_USER_RE = re.compile(r"\(([^(]*)\)\s*\Z")
+
 def parse_ban(raw_ban_str:str):
-    """Attempts to return the user who caused the ban"""
+    """Attempts to return the user who caused the ban, 
+    None if the reason doesn't end with one"""
     temp, length , reason = raw_ban_str.split("_", 2)
 
-    # Remove whitespace characters if there's any to foil us...
-    reason = reason.rstrip()
-    # Check if reason is carrying the user who caused this to occur at the end of the string
-    if reason.endswith(")") and reason.rfind("(") != -1:
-        user = reason[reason.rfind("(") + 1 :reason.rfind(")")]
-        return user 
+    # Trailing whitespace is allowed by the pattern incase there's any to foil us...
+    match = _BAN_USER_RE.search(reason)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+
+@lru_cache(maxsize=256)
+def _gjp2(password:bytes):
+    # gjp2 and chks are just part of gd's protocol, they don't need to go through any FIPS checks
+    return hashlib.new("sha1", password + b"mI29fmAnxgTs", usedforsecurity=False).hexdigest()
 
 
 
@@ -68,7 +144,7 @@ class IDModel(SQLModel):
 
 class User(IDModel, table=True):
     """The User Model for a bot account"""
-    name:str
+    name:str = Field(index=True)
     password:bytes
     accountID:int
 
@@ -81,15 +157,16 @@ class User(IDModel, table=True):
     # Look at the GameLevelManager's code or see it in ghidra.
     @property
     def gjp2(self):
-        return sha1(self.password + b"mI29fmAnxgTs").hexdigest()
+        # passwords are immutable bytes so this can be remembered outside of the row
+        return _gjp2(self.password)
 
     def level_comment_chk(self, b64_content:str, levelID:Union[int, str]):
         """Makes a chk for level comment related content"""
-        return comment_chk(self.username, b64_content, id=levelID, comment_type=1)
+        return comment_chk(self.name, b64_content, id=levelID, comment_type=1)
 
     def profile_comment_chk(self, b64_content:str):
         """Makes a chk for profile comment releated content"""
-        return comment_chk(self.username, b64_content, id=0, comment_type=0)
+        return comment_chk(self.name, b64_content, id=0, comment_type=0)
 
     @property
     def isabstract(self):
@@ -109,38 +186,116 @@ class Ban(IDModel, table=True):
     # don't know it yet.
     raw_ban_str:str 
 
-    real_user:Optional[str] = None 
+    real_user:Optional[str] = Field(default=None, index=True)
     """The banned user issued in the raw ban string, this may or may not be us."""
 
+    user_id:Optional[int] = Field(default=None, foreign_key="user.id", index=True)
     user:Optional[User] = Relationship(back_populates="bans")
-    user_id:Optional[int] = Relationship(back_populates="user.id")
 
 
-@attrs.define
+# The hot lookups are built once here and fed their values as parameters, 
+# this way we aren't rebuilding the same select on every single check
+_SELECT_BAN_BY_HOST = select(Ban).where(Ban.host == bindparam("host")).options(selectinload(Ban.user))
+_SELECT_BOT_BY_NAME = select(User).where(User.name == bindparam("username")).options(selectinload(User.bans))
+# One EXISTS covers both the bans that named us and the bans our account caused
+_SELECT_USER_IS_BANNED = select(
+    exists().where(or_(Ban.real_user == bindparam("username"), Ban.user.has(User.name == bindparam("username"))))
+)
+
+
+def _ban_snapshot(ban:Ban):
+    """Copies a loaded ban (and the user who caused it) into 
+    one that doesn't belong to any session"""
+    user = ban.user
+    if user is not None:
+        user = User(id=user.id, name=user.name, password=user.password, accountID=user.accountID)
+    return Ban(
+        id=ban.id, 
+        host=ban.host, 
+        raw_ban_str=ban.raw_ban_str, 
+        real_user=ban.real_user, 
+        user_id=ban.user_id, 
+        user=user
+    )
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    """Tunes every new sqlite connection, WAL lets our ban checks 
+    keep reading while another bot is busy writing a ban"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
 class Database:
-    
-    name:str = "bots.db"
-    engine:AsyncEngine = attrs.field(init=False)
-    initalized:bool = attrs.field(init=False, default=False)
-    maker:async_sessionmaker[AsyncSession] = attrs.field(init=False)
+    __slots__ = ("name", "ban_cache_size", "ban_cache_ttl", "engine", "initalized", "maker", "_ban_cache", "_ban_epoch", "_init_lock")
 
-    def __attrs_post_init__(self):
-        self.engine = create_async_engine("aiosqlite+sqlite:///%s" % self.name)
+    name:str
+    ban_cache_size:int
+    """How many proxy hosts to remember the ban status of before forgetting the oldest one"""
+    ban_cache_ttl:float
+    """How many seconds a host's ban status is trusted before asking the database again, 
+    this is what lets us notice bans written by other bots sharing the same database file"""
+    engine:AsyncEngine
+    initalized:bool
+    maker:async_sessionmaker[AsyncSession]
+    _ban_cache:OrderedDict[str, tuple[float, Optional[Ban]]]
+    _ban_epoch:int
+    """Bumped on every ban we issue so lookups that raced with it know not to cache their answer"""
+    _init_lock:Optional[asyncio.Lock]
+
+    def __init__(self, name:str = "bots.db", ban_cache_size:int = 512, ban_cache_ttl:float = 60.0):
+        self.name = name
+        self.ban_cache_size = ban_cache_size
+        self.ban_cache_ttl = ban_cache_ttl
+        self.initalized = False
+        self._ban_cache = OrderedDict()
+        self._ban_epoch = 0
+        self.engine = create_async_engine(
+            "sqlite+aiosqlite:///%s" % self.name,
+            connect_args={"timeout": 5},
+        )
+        event.listen(self.engine.sync_engine, "connect", _sqlite_pragmas)
         self.maker = async_sessionmaker(self.engine, class_=AsyncSession)
+        # Made by init_db, python 3.9 would tie a lock made here to whatever loop is around at import time
+        self._init_lock = None
+
+    def __repr__(self):
+        return f"Database(name={self.name!r}, ban_cache_size={self.ban_cache_size!r}, ban_cache_ttl={self.ban_cache_ttl!r})"
 
     async def init_db(self):
+        """Creates the tables if they don't exist yet, call this once when your bot starts 
+        up otherwise the first session made will do it for you"""
         # Prevent repeate initalization on the user's developing end...
-        if not self.initalized:
-            async with self.maker() as s:
-                await s.run_sync(IDModel.metadata.create_all())
-                await s.commit()
+        if self.initalized:
+            return
+        # Every bot's first session can land here at once so only let one of them run create_all
+        if self._init_lock is None:
+            self._init_lock = asyncio.Lock()
+        async with self._init_lock:
+            if self.initalized:
+                return
+            async with self.engine.begin() as conn:
+                await conn.run_sync(IDModel.metadata.create_all)
             self.initalized = True
 
     @asynccontextmanager
-    async def session(self):
+    async def session(self, session:Optional[AsyncSession] = None):
         """Issues a new session to the database, you can 
         find more information about what a session does on 
-        sqlalchemy or sqlmodel's docs"""
+        sqlalchemy or sqlmodel's docs
+
+        session: an already open session to reuse, it's handed right 
+        back and is left open for whoever opened it. Writes made on it 
+        are only flushed, committing them is up to its owner"""
+        if session is not None:
+            yield session
+            return
+
         # Has the database been created yet?
         if not self.initalized:
             await self.init_db()
@@ -149,74 +304,155 @@ class Database:
             yield s
 
 
-    async def proxy_is_banned(self, proxy:str):
+    async def _finish_write(self, s:AsyncSession, borrowed:bool, hosts:Iterable[Optional[str]] = ()):
+        """Commits the sessions we opened ourselves, sessions handed to us only 
+        get flushed so we don't commit anything else their owner has pending"""
+        hosts = tuple(hosts)
+        if not borrowed:
+            await s.commit()
+            if hosts:
+                self._forget_bans(hosts)
+            return
+
+        await s.flush()
+        if hosts:
+            # Forget now for anyone reading through this session and again once the 
+            # owner commits so other sessions don't keep an answer from before the ban
+            self._forget_bans(hosts)
+            event.listen(s.sync_session, "after_commit", lambda _: self._forget_bans(hosts), once=True)
+
+    def _forget_bans(self, hosts:Iterable[Optional[str]]):
+        """Drops these hosts from the ban cache after a ban gets committed"""
+        self._ban_epoch += 1
+        for host in hosts:
+            self._ban_cache.pop(host, None)
+
+    async def proxy_is_banned(self, proxy:str, session:Optional[AsyncSession] = None):
         """Checks if this proxy was banned
         this will return the ban the corresponds 
         to the host that's been banned good for when 
         we need more information such as who the hell 
         caused it
 
+        Answers are cached for ban_cache_ttl seconds, bans issued through 
+        this Database show up right away but ones written by another 
+        process or Database instance can take up to that long to be seen
+
         proxy: the proxy url or IP address of the host to lookup
         
-        returns: the user ban if found, None if we're safe to continue"""
-
-        # Incase skid code is being performed...
-        proxy = fix_skid_proxy(proxy)
+        returns: the user ban if found, None if we're safe to continue. 
+        The ban is a fresh copy that isn't tied to any session and comes 
+        with the user who caused it already loaded"""
 
         # I expect the user developer to be using http:// socks4:// socks5:// or all:// in their shit...
-        host = urlparse(proxy).hostname
-        async with self.session() as s:
-            result = await s.exec(select(Ban).where(Ban.host == host))
+        # proxy_host also takes care of any skid proxies we get handed
+        host = proxy_host(proxy)
+
+        # Our own bans clear the cache right away, anyone else's get picked up once the entry expires
+        entry = self._ban_cache.get(host)
+        if entry is not None:
+            stamp, cached = entry
+            if time.monotonic() - stamp < self.ban_cache_ttl:
+                self._ban_cache.move_to_end(host)
+                # Hand out a fresh copy so nobody can scribble over what we've cached
+                return _ban_snapshot(cached) if cached is not None else None
+            del self._ban_cache[host]
+
+        epoch = self._ban_epoch
+        stamp = time.monotonic()
+        async with self.session(session) as s:
+            result = await s.exec(_SELECT_BAN_BY_HOST, params={"host": host})
             ban = result.one_or_none()
-        return ban 
+            # Cache a copy that isn't tied to this session, the session may be the 
+            # caller's and committing it later would expire the ban out from under us
+            cached = _ban_snapshot(ban) if ban is not None else None
 
-    async def new_bot_account(self, username:str, password:str, accountID:int):
-        """Registers a new bot account to our database, remeber this should be done after registry completes."""
-        async with self.session() as s:
+        # A ban was issued while we were reading so our answer might already be out of date
+        if epoch == self._ban_epoch:
+            self._ban_cache[host] = (stamp, cached)
+            if len(self._ban_cache) > self.ban_cache_size:
+                self._ban_cache.popitem(last=False)
+
+        # Misses get their own copy too so they look the same as a cache hit would
+        return _ban_snapshot(cached) if cached is not None else None
+
+    async def new_bot_account(self, username:str, password:str, accountID:int, session:Optional[AsyncSession] = None):
+        """Registers a new bot account to our database, remeber this should be done after registry completes.
+        
+        only flushes the session it's given, committing it is left to you"""
+        async with self.session(session) as s:
             result = await s.merge(User(name=username, password=password.encode("utf-8"), accountID=accountID))
-            await s.commit()
+            await self._finish_write(s, session is not None)
         return result
 
-    async def get_bot(self, username:str):
+    async def get_bot(self, username:str, session:Optional[AsyncSession] = None):
         """Obtains a bot that is already registered in our database"""
-        async with self.session() as s:
-            result = await s.exec(select(User).where(User.name == username))
+        async with self.session(session) as s:
+            # The bans are loaded up front, lazy loading user.bans after the session closes won't work under asyncio
+            result = await s.exec(_SELECT_BOT_BY_NAME, params={"username": username})
             user = result.one_or_none()
         return user
     
-    async def issue_ban(self, ban_str:str, caused_by:User, proxy:str):
+    async def issue_ban(self, ban_str:str, caused_by:User, proxy:str, session:Optional[AsyncSession] = None):
         """Issues the comment ban to the user and system so the script 
-        will try not hitting it again. This bans the user and other possible casualties"""
-        async with self.session() as s:
+        will try not hitting it again. This bans the user and other possible casualties
+        
+        only flushes the session it's given, committing it is left to you"""
+        host = proxy_host(proxy)
+        async with self.session(session) as s:
             await s.merge(
                 Ban(
-                    host=urlparse(fix_skid_proxy(proxy)).hostname, 
+                    host=host, 
                     raw_ban_str=ban_str, 
                     real_user=parse_ban(ban_str), 
                     user=caused_by)
             )
-            await s.commit()
+            # Forget whatever we knew about this host so the next check picks up the new ban
+            await self._finish_write(s, session is not None, (host,))
+
+    async def issue_bans(self, bans:Iterable[tuple[str, Optional[User], str]], session:Optional[AsyncSession] = None):
+        """Issues many comment bans at once, each one given as 
+        (ban_str, caused_by, proxy) just like issue_ban takes them.
+        Hosts that are already banned keep their first ban, this is 
+        what you want when all your workers are reporting in at the same time
+        
+        only flushes the session it's given, committing it is left to you"""
+        bans = [(proxy_host(proxy), ban_str, caused_by) for ban_str, caused_by, proxy in bans]
+        if not bans:
+            return
+
+        async with self.session(session) as s:
+            # issue_ban's merge saves a user that isn't in the database yet, do the 
+            # same here and flush so every ban still gets tied to the user's id
+            unsaved:dict[int, User] = {}
+            for _, _, caused_by in bans:
+                if caused_by is not None and caused_by.id is None and id(caused_by) not in unsaved:
+                    unsaved[id(caused_by)] = await s.merge(caused_by)
+            if unsaved:
+                await s.flush()
+
+            rows = []
+            for host, ban_str, caused_by in bans:
+                if caused_by is not None:
+                    caused_by = unsaved.get(id(caused_by), caused_by)
+                rows.append({
+                    "host": host,
+                    "raw_ban_str": ban_str,
+                    "real_user": parse_ban(ban_str),
+                    "user_id": caused_by.id if caused_by is not None else None
+                })
+            await s.exec(insert(Ban).on_conflict_do_nothing(index_elements=["host"]), params=rows)
+            await self._finish_write(s, session is not None, (host for host, _, _ in bans))
     
-    async def user_is_banned(self, username:str):
+    async def user_is_banned(self, username:str, session:Optional[AsyncSession] = None):
         """Checks if the user is banned,
         returns a boolean if found on either the username or any issued ban"""
 
-        async with self.session() as s:
-            result = await s.exec(select(User).where(User.name == username))
-            user = result.one_or_none() 
-            # are we carrying any bans with this user?
-            if user.bans:
-                return True
+        async with self.session(session) as s:
+            result = await s.exec(_SELECT_USER_IS_BANNED, params={"username": username})
+            return bool(result.one())
 
-            result2 = await s.exec(select(Ban).where(Ban.real_user == username))
-            
-            if result2.one_or_none():
-                return True 
-        
-        # We are 100% safe with using this specific self-bot
-        return False 
-
-    async def user_and_proxy_are_banned(self, username:str, proxy:str):
+    async def user_and_proxy_are_banned(self, username:str, proxy:str, session:Optional[AsyncSession] = None):
         """Checks to see if the user and proxy are banned,
         if one of these turn up as true then this function returns true as one of 
         these items are not safe to use.
@@ -224,11 +460,17 @@ class Database:
         You really should be checking these individually if your goal is to save time in exection vs 
         writing"""
 
-        if await self.proxy_is_banned(proxy):
-            return True 
-        if await self.user_is_banned(username):
-            return True
-        # Were safe to use both the proxy and username
-        return False 
+        # A single session can't be used by two queries at once so anything handed to us goes one at a time
+        if session is not None:
+            if await self.proxy_is_banned(proxy, session=session):
+                return True 
+            if await self.user_is_banned(username, session=session):
+                return True
+            # Were safe to use both the proxy and username
+            return False
+
+        # Otherwise run both checks side by side, the pool has more than enough connections for the two of them
+        proxy_ban, user_ban = await asyncio.gather(self.proxy_is_banned(proxy), self.user_is_banned(username))
+        return bool(proxy_ban) or user_ban 
 
 